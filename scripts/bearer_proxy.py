@@ -1,128 +1,421 @@
 #!/usr/bin/env python3
-import argparse, os, socket, threading, select, sys, base64
+import argparse, asyncio, errno, os, selectors, signal, socket, sys, traceback, base64
+try: import resource
+except ImportError: resource = None
 from urllib.parse import urlsplit
 
-def pump(a, b):
+SOCK_BUF_BYTES = 4 * 1024 * 1024
+NOTSENT_LOWAT_BYTES = 16384
+HDR_SLAB_BYTES = 65536
+HDR_SLAB_POOL = 64
+# A tunnel with no bytes in either direction for this long is closed to free its slot
+TUNNEL_IDLE_TIMEOUT_S = 600
+
+OK200 = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+BAD502 = b"HTTP/1.1 502 Bad Gateway\r\n\r\n"
+ISE500 = b"HTTP/1.1 500 Internal Server Error\r\n\r\n"
+# Stand-in for the client's host:port in the prebuilt CONNECT requests; NUL never appears in a request target
+HOSTPORT = b"\x00HOSTPORT\x00"
+
+MULTI_WORKER = hasattr(os, "fork")
+# accept() failures that mean "not right now" rather than a broken listener
+ACCEPT_RETRY_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM, errno.ECONNABORTED}
+ACCEPT_BACKOFF_S = 1
+# fds kept back from max_clients for the listener, stdio, DNS lookups and the like
+FD_RESERVE = 32
+
+_hdr_slabs = []
+
+def tune_socket(s, nodelay=True):
+    # Set before listen()/connect() so the larger window is negotiated at handshake time
+    for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try: s.setsockopt(socket.SOL_SOCKET, opt, SOCK_BUF_BYTES)
+        except OSError: pass
+    if nodelay:
+        try: s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError: pass
+        # Keep only a little unsent data queued so the big SO_SNDBUF doesn't add latency
+        if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+            try: s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT_BYTES)
+            except OSError: pass
+
+async def _copy(loop, src, dst, seen):
+    # One buffer per direction for the life of the tunnel instead of a bytes object per chunk
+    mv = memoryview(bytearray(65536))
+    while True:
+        n = await loop.sock_recv_into(src, mv)
+        if not n: break
+        seen[0] = loop.time()
+        await loop.sock_sendall(dst, mv[:n])
+
+async def _wait_fd(loop, fd, add, remove):
+    fut = loop.create_future()
+    add(fd, lambda: fut.done() or fut.set_result(None))
+    try: await fut
+    finally: remove(fd)
+
+async def _splice(loop, src, dst, seen):
+    # Linux: move bytes socket -> pipe -> socket inside the kernel, never through Python
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    sfd, dfd = src.fileno(), dst.fileno()
+    # Each direction needs its own pipe (2 more fds); if we're out of fds, copy through Python instead
+    try: r, w = os.pipe()
+    except OSError:
+        return await _copy(loop, src, dst, seen)
     try:
-        sockets = [a, b]
         while True:
-            r, _, _ = select.select(sockets, [], [], 60)
-            if a in r:
-                d = a.recv(65536)
-                if not d: break
-                b.sendall(d)
-            if b in r:
-                d = b.recv(65536)
-                if not d: break
-                a.sendall(d)
+            try: n = os.splice(sfd, w, 1 << 20, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop, sfd, loop.add_reader, loop.remove_reader)
+                continue
+            if not n: break
+            seen[0] = loop.time()
+            while n:
+                try: n -= os.splice(r, dfd, n, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop, dfd, loop.add_writer, loop.remove_writer)
     finally:
+        os.close(r); os.close(w)
+
+_pump_copy = _splice if hasattr(os, "splice") else _copy
+# Client and upstream sockets, plus a pipe pair per direction when splicing
+FDS_PER_TUNNEL = 6 if _pump_copy is _splice else 2
+
+async def pump(loop, a, b, a_to_b=None, seen=None):
+    # a_to_b: an a -> b copy task that is already running, sharing `seen` (see pipelined_connect)
+    # seen[0]: loop time of the last byte moved in either direction
+    seen = seen or [loop.time()]
+    tasks = [a_to_b or loop.create_task(_pump_copy(loop, a, b, seen)), loop.create_task(_pump_copy(loop, b, a, seen))]
+    try:
+        while True:
+            idle = loop.time() - seen[0]
+            if idle >= TUNNEL_IDLE_TIMEOUT_S: break
+            finished, _ = await asyncio.wait(tasks, timeout=TUNNEL_IDLE_TIMEOUT_S - idle,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            if finished: break
+    finally:
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         for s in (a,b):
             try: s.shutdown(socket.SHUT_RDWR)
             except: pass
             try: s.close()
             except: pass
 
-def recv_until(sock, sep=b"\r\n\r\n", limit=65536):
-    buf = b""
-    while sep not in buf:
-        chunk = sock.recv(4096)
-        if not chunk: break
-        buf += chunk
-        if len(buf) > limit: break
-    return buf
+async def recv_until(loop, sock, sep=b"\r\n\r\n", limit=HDR_SLAB_BYTES):
+    # Read into a recycled slab; many connections can be mid-handshake at once,
+    # so slabs come from a free list rather than one buffer per thread
+    slab = _hdr_slabs.pop() if _hdr_slabs else bytearray(HDR_SLAB_BYTES)
+    mv = memoryview(slab)
+    end = min(limit, len(slab))
+    off = 0
+    try:
+        while off < end:
+            # Only rescan the tail that could hold a separator split across reads
+            search_from = max(0, off - len(sep) + 1)
+            n = await loop.sock_recv_into(sock, mv[off:end])
+            if not n: break
+            off += n
+            if slab.find(sep, search_from, off) != -1: break
+        return bytes(mv[:off])
+    finally:
+        if len(_hdr_slabs) < HDR_SLAB_POOL: _hdr_slabs.append(slab)
+
+async def open_connection(loop, host, port, timeout=30):
+    err = None
+    for family, type_, proto, _, addr in await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        s = socket.socket(family, type_, proto)
+        s.setblocking(False)
+        tune_socket(s)
+        try:
+            await asyncio.wait_for(loop.sock_connect(s, addr), timeout)
+            return s
+        except (OSError, asyncio.TimeoutError) as e:
+            err = e
+            s.close()
+    raise err or OSError(f"could not resolve {host}:{port}")
+
+def body_remaining(resp: bytes):
+    # Body bytes still to read before the socket can carry another request,
+    # or None if the proxy wants it closed or framing isn't a single plain Content-Length
+    hdr_end = resp.find(b"\r\n\r\n")
+    if hdr_end == -1 or not resp.startswith(b"HTTP/1.1 "): return None
+    body_len = len(resp) - hdr_end - 4
+    length = None
+    # Walk header lines in place (the status line is skipped); no head/body/line copies
+    pos = resp.find(b"\r\n") + 2
+    while pos < hdr_end:
+        eol = resp.find(b"\r\n", pos, hdr_end + 2)
+        colon = resp.find(b":", pos, eol)
+        if colon != -1:
+            name = resp[pos:colon].strip().lower()
+            if name == b"transfer-encoding":
+                return None
+            if name in (b"connection", b"proxy-connection"):
+                if b"close" in (t.strip() for t in resp[colon + 1:eol].lower().split(b",")):
+                    return None
+            if name == b"content-length":
+                try: value = int(resp[colon + 1:eol])
+                except ValueError: return None
+                if length is not None and value != length: return None
+                length = value
+        pos = eol + 2
+    if length is None or length < body_len: return None
+    return length - body_len
+
+async def drain_for_reuse(loop, corp, resp) -> bool:
+    remaining = body_remaining(resp)
+    if remaining is None or remaining > HDR_SLAB_BYTES: return False
+    while remaining:
+        # A slow or broken body just costs the reuse; the caller dials a fresh connection
+        try: chunk = await asyncio.wait_for(loop.sock_recv(corp, remaining), 30)
+        except (OSError, asyncio.TimeoutError): return False
+        if not chunk: return False
+        remaining -= len(chunk)
+    return True
+
+def fit_fd_limit(want):
+    # Raise the RLIMIT_NOFILE soft limit (up to the hard one) for want tunnels; returns how many fit
+    if resource is None: return want
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = want * FDS_PER_TUNNEL + FD_RESERVE
+    if soft != resource.RLIM_INFINITY and soft < need:
+        target = need if hard == resource.RLIM_INFINITY else min(need, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError): pass
+    if soft == resource.RLIM_INFINITY: return want
+    return max(1, min(want, (soft - FD_RESERVE) // FDS_PER_TUNNEL))
+
+def positive_int(text):
+    try: n = int(text)
+    except ValueError: n = 0
+    if n < 1: raise argparse.ArgumentTypeError(f"expected an integer >= 1, got {text!r}")
+    return n
 
 def mk_basic(user, pwd):
     raw = f"{user}:{pwd}".encode("utf-8")
     return "Basic " + base64.b64encode(raw).decode("ascii")
 
 def first_line_status(hdr: bytes) -> bytes:
-    return hdr.split(b"\r\n",1)[0] if hdr else b""
-
-def try_connect_with_headers(corp, hostport, headers):
-    req = (f"CONNECT {hostport} HTTP/1.1\r\n"
-           f"Host: {hostport}\r\n" +
-           "".join(h + "\r\n" for h in headers) +
-           "Proxy-Connection: keep-alive\r\n"
-           "Connection: keep-alive\r\n\r\n").encode("latin-1")
-    corp.sendall(req)
-    resp = recv_until(corp)
-    return resp
+    end = hdr.find(b"\r\n")
+    return hdr if end == -1 else hdr[:end]
 
-def handle_client(client, thost, tport, bearer_raw, basic_hdr=None, also_auth_header=False):
-    try:
-        first = recv_until(client)
-        if not first:
-            client.close(); return
+def connect_template(headers):
+    return b"".join([b"CONNECT ", HOSTPORT, b" HTTP/1.1\r\nHost: ", HOSTPORT, b"\r\n",
+                     *(h + b"\r\n" for h in headers),
+                     b"Proxy-Connection: keep-alive\r\n"
+                     b"Connection: keep-alive\r\n\r\n"])
+
+async def try_connect_with_template(loop, corp, hostport, template):
+    req = template.replace(HOSTPORT, hostport)
+    await loop.sock_sendall(corp, req)
+    resp = await asyncio.wait_for(recv_until(loop, corp), 30)
+    return resp
 
-        # Normalize token (strip "jwt_" prefix if present)
-        token = bearer_raw
-        if token.startswith("jwt_"):
-            token = token[4:]
+def build_headers_sets(bearer_raw, basic_hdr=None, also_auth_header=False):
+    # Normalize token (strip "jwt_" prefix if present)
+    token = bearer_raw.encode("latin-1")
+    if token.startswith(b"jwt_"):
+        token = token[4:]
+    basic = basic_hdr.encode("latin-1") if basic_hdr else None
 
-        # Prepare auth headers we'll try (order matters)
-        headers_sets = []
+    # Prepare auth headers we'll try (order matters)
+    headers_sets = []
 
-        # 1) Proxy-Authorization: Bearer <token>
-        headers_sets.append([f"Proxy-Authorization: Bearer {token}"])
+    # 1) Proxy-Authorization: Bearer <token>
+    headers_sets.append([b"Proxy-Authorization: Bearer " + token])
 
-        # 2) Proxy-Authorization + Authorization (some proxies want Authorization even for CONNECT)
+    # 2) Proxy-Authorization + Authorization (some proxies want Authorization even for CONNECT)
+    if also_auth_header:
+        headers_sets.append([b"Proxy-Authorization: Bearer " + token,
+                             b"Authorization: Bearer " + token])
+    # 3) Add Basic if provided (some proxies require Basic, ignore Bearer)
+    if basic:
+        headers_sets.append([b"Proxy-Authorization: " + basic])
         if also_auth_header:
-            headers_sets.append([f"Proxy-Authorization: Bearer {token}",
-                                 f"Authorization: Bearer {token}"])
-        # 3) Add Basic if provided (some proxies require Basic, ignore Bearer)
-        if basic_hdr:
-            headers_sets.append([f"Proxy-Authorization: {basic_hdr}"])
-            if also_auth_header:
-                headers_sets.append([f"Proxy-Authorization: {basic_hdr}",
-                                     f"Authorization: {basic_hdr}"])
+            headers_sets.append([b"Proxy-Authorization: " + basic,
+                                 b"Authorization: " + basic])
+    return headers_sets
+
+async def pipelined_connect(loop, client, corp, hostport, template):
+    # Answer the client before the corp proxy does so its first flight (TLS ClientHello)
+    # follows the CONNECT upstream immediately, saving one upstream round trip
+    await loop.sock_sendall(corp, template.replace(HOSTPORT, hostport))
+    await loop.sock_sendall(client, OK200)
+    seen = [loop.time()]
+    up = loop.create_task(_pump_copy(loop, client, corp, seen))
+    ok = False
+    try:
+        resp = await asyncio.wait_for(recv_until(loop, corp), 30)
+        hdr_end = resp.find(b"\r\n\r\n")
+        if hdr_end != -1 and b" 200 " in first_line_status(resp):
+            # Anything after the header is already tunnel data (e.g. ServerHello)
+            if hdr_end + 4 < len(resp):
+                await loop.sock_sendall(client, resp[hdr_end + 4:])
+            ok = True
+    finally:
+        if not ok:
+            # Too late for a 502: the client already has its 200, so just drop both sides
+            up.cancel()
+            await asyncio.gather(up, return_exceptions=True)
+            corp.close(); client.close()
+    if ok:
+        await pump(loop, client, corp, a_to_b=up, seen=seen)
+
+async def handle_client(loop, client, thost, tport, templates, pipeline=False):
+    try:
+        # A client that never sends its CONNECT would otherwise hold a max_clients slot forever
+        first = await asyncio.wait_for(recv_until(loop, client), 30)
+        if not first:
+            client.close(); return
+
+        # Request line is "CONNECT host:port HTTP/1.1"; keep the target as bytes
+        _, _, rest = first.partition(b" ")
+        hostport, _, _ = rest.partition(b" ")
 
         # Open upstream connection to corp proxy
-        hostport = f"{thost}:{tport}"
-        corp = socket.create_connection((thost, tport), timeout=30)
+        corp = await open_connection(loop, thost, tport)
+        reused = False
+
+        if pipeline:
+            await pipelined_connect(loop, client, corp, hostport, templates[0])
+            return
 
         # Try header strategies until one returns 200
         ok = False
         last_status = b""
-        for hs in headers_sets:
-            resp = try_connect_with_headers(corp, hostport=first.split(b" ")[1].decode("latin-1"), headers=hs)
+        for tpl in templates:
+            try: resp = await try_connect_with_template(loop, corp, hostport=hostport, template=tpl)
+            except OSError:
+                if not reused: raise
+                resp = b""
+            if not resp and reused:
+                # Proxy closed the connection despite keep-alive; retry this strategy on a fresh one
+                corp.close()
+                corp, reused = await open_connection(loop, thost, tport), False
+                resp = await try_connect_with_template(loop, corp, hostport=hostport, template=tpl)
             status = first_line_status(resp)
             last_status = status
             if b" 200 " in status:
                 # Tunnel established with this header set
-                client.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-                pump(client, corp)
+                await loop.sock_sendall(client, OK200)
+                # Anything read past the header is already tunnel data (e.g. ServerHello, SSH banner)
+                hdr_end = resp.find(b"\r\n\r\n")
+                if hdr_end != -1 and hdr_end + 4 < len(resp):
+                    await loop.sock_sendall(client, resp[hdr_end + 4:])
+                await pump(loop, client, corp)
                 ok = True
                 break
-            # Not OK; reopen socket and try next strategy
+            # Not OK; a 407 usually leaves the connection open, so send the next strategy on it
+            reusable = await drain_for_reuse(loop, corp, resp)
+            if tpl is templates[-1]: break
+            if reusable:
+                reused = True
+                continue
             try: corp.close()
             except: pass
-            corp = socket.create_connection((thost, tport), timeout=30)
+            corp, reused = await open_connection(loop, thost, tport), False
 
         if not ok:
             # Propagate last response (useful for debugging)
-            client.sendall((last_status or b"HTTP/1.1 502 Bad Gateway") + b"\r\n\r\n")
+            await loop.sock_sendall(client, last_status + b"\r\n\r\n" if last_status else BAD502)
             corp.close(); client.close()
             return
 
     except Exception:
-        try: client.sendall(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")
+        try: await loop.sock_sendall(client, ISE500)
         except: pass
         try: client.close()
         except: pass
 
-def serve(listen_host, listen_port, target_host, target_port, bearer, basic_hdr, also_auth_header):
+def listen_socket(listen_host, listen_port):
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tune_socket(srv, nodelay=False)
     srv.bind((listen_host, listen_port))
     srv.listen(128)
-    print(f"[bearer-proxy] listening on {listen_host}:{listen_port} -> proxy {target_host}:{target_port}", flush=True)
+    srv.setblocking(False)
+    return srv
+
+async def serve(listen_host, listen_port, target_host, target_port, bearer, basic_hdr, also_auth_header,
+                pipeline=False, max_clients=512, srv=None, announce=True):
+    loop = asyncio.get_running_loop()
+    templates = [connect_template(hs) for hs in build_headers_sets(bearer, basic_hdr, also_auth_header)]
+    # Workers are handed the listener their parent already bound
+    if srv is None:
+        srv = listen_socket(listen_host, listen_port)
+    if announce:
+        print(f"[bearer-proxy] listening on {listen_host}:{listen_port} -> proxy {target_host}:{target_port}", flush=True)
+    # The loop only keeps weak references to tasks; hold them until they finish
+    clients = set()
+    # Stop accepting at max_clients so bursts queue in the listen backlog instead of piling up here
+    slots = asyncio.Semaphore(max_clients)
+
+    def done(t):
+        clients.discard(t)
+        slots.release()
+
     while True:
-        c, _ = srv.accept()
-        threading.Thread(
-            target=handle_client,
-            args=(c, target_host, target_port, bearer, basic_hdr, also_auth_header),
-            daemon=True
-        ).start()
+        await slots.acquire()
+        try: c, _ = await loop.sock_accept(srv)
+        except OSError as e:
+            slots.release()
+            if e.errno not in ACCEPT_RETRY_ERRNOS: raise
+            # Out of fds/memory or the client gave up; keep serving, as asyncio.start_server does
+            print(f"[bearer-proxy] accept failed: {e}", file=sys.stderr, flush=True)
+            if e.errno != errno.ECONNABORTED: await asyncio.sleep(ACCEPT_BACKOFF_S)
+            continue
+        except BaseException:
+            slots.release()
+            raise
+        tune_socket(c)
+        t = loop.create_task(handle_client(loop, c, target_host, target_port, templates, pipeline))
+        clients.add(t)
+        t.add_done_callback(done)
+
+def run(*serve_args, **serve_kw):
+    # One epoll/kqueue selector shared by every tunnel. Windows keeps its default proactor (IOCP)
+    # loop: its selector is select(), capped at 512 sockets, and the copy path only needs sock_* calls
+    if sys.platform == "win32": loop = asyncio.new_event_loop()
+    else: loop = asyncio.SelectorEventLoop(selectors.DefaultSelector())
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve(*serve_args, **serve_kw))
+
+def run_workers(n, *serve_args):
+    # Bind once here so a port that's already taken fails with EADDRINUSE instead of being
+    # shared; the children inherit the listener and the kernel hands each accept to one of them.
+    # Fork before any event loop exists so every child builds its own.
+    srv = listen_socket(serve_args[0], serve_args[1])
+    pids = []
+    for i in range(n):
+        pid = os.fork()
+        if pid == 0:
+            try: run(*serve_args, srv=srv, announce=i == 0)
+            except KeyboardInterrupt: os._exit(0)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        pids.append(pid)
+    srv.close()
+
+    def stop(code=0):
+        for pid in pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+        sys.exit(code)
+
+    signal.signal(signal.SIGTERM, lambda *_: stop())
+    try:
+        # A worker exiting on its own means it failed; take the rest down and report it
+        while pids:
+            pid, status = os.wait()
+            pids.remove(pid)
+            if status != 0: stop(1)
+    except KeyboardInterrupt:
+        stop()
 
 if __name__ == "__main__":
     # Pull defaults from env HTTPS_PROXY if available (to auto-make Basic header)
@@ -139,7 +432,19 @@ if __name__ == "__main__":
     ap.add_argument("--bearer", default=os.environ.get("PROXY_BEARER","") or p)
     ap.add_argument("--also-auth-header", action="store_true", help="Send Authorization: ... alongside Proxy-Authorization")
     ap.add_argument("--with-basic", action="store_true", help="Also try Basic from HTTPS_PROXY creds before giving up")
+    ap.add_argument("--pipeline-connect", action="store_true",
+                    help="Reply 200 before the upstream proxy answers CONNECT (first auth strategy only; "
+                         "a rejected CONNECT drops the client instead of returning 502)")
+    # String default so argparse runs it (and PROXY_MAX_CLIENTS) through positive_int too
+    ap.add_argument("--max-clients", type=positive_int,
+                    default=os.environ.get("PROXY_MAX_CLIENTS") or str(fit_fd_limit(512)),
+                    help="Concurrent connections per worker before accepting pauses "
+                         "(default 512, lowered to fit the open-file limit)")
+    ap.add_argument("--workers", type=int, default=(os.cpu_count() or 1) if sys.platform.startswith("linux") else 1,
+                    help="Worker processes accepting on one shared listen socket (default: CPU count on Linux)")
     args = ap.parse_args()
+    # An explicit --max-clients above the default still needs the fds for it
+    fit_fd_limit(args.max_clients)
 
     if ":" not in args.target:
         print("Set TARGET_PROXY_HOST and TARGET_PROXY_PORT or pass --target host:port", file=sys.stderr)
@@ -149,4 +454,12 @@ if __name__ == "__main__":
     th, tp = args.target.split(":")
 
     basic_hdr = mk_basic(u, args.bearer) if args.with_basic and u else None
-    serve(lh, int(lp), th, int(tp), args.bearer, basic_hdr, args.also_auth_header)
+    serve_args = (lh, int(lp), th, int(tp), args.bearer, basic_hdr, args.also_auth_header, args.pipeline_connect,
+                  args.max_clients)
+    if args.workers > 1 and not MULTI_WORKER:
+        print("[bearer-proxy] --workers needs os.fork; running a single worker", file=sys.stderr)
+        args.workers = 1
+    if args.workers > 1:
+        run_workers(args.workers, *serve_args)
+    else:
+        run(*serve_args)